@@ -1,118 +1,596 @@
 import os
 import time
+import atexit
+import functools
+import heapq
+import logging
+import logging.handlers
+import math
+import queue
+import signal
+import sqlite3
+import threading
 import requests
-from datetime import datetime, timezone, timedelta
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from decimal import Decimal, ROUND_DOWN
+from binance import ThreadedWebsocketManager
 from binance.client import Client
 from dotenv import load_dotenv
 import pytz
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 load_dotenv()
+
+# Console output goes through a queue so a slow stdout never stalls the trading loop
+log = logging.getLogger('funding_bot')
+log.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+log.propagate = False
+_log_q = queue.Queue()
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+log.addHandler(logging.handlers.QueueHandler(_log_q))
+_log_listener = logging.handlers.QueueListener(_log_q, _log_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+@dataclass(slots=True)
+class RateRow:
+    rate: float
+    interval: int
+    rate_pct_str: str
+    sec_to_funding: float = 0.0
+    countdown_str: str = ''
+
+@dataclass(slots=True)
+class EntryRecord:
+    entry_price: float
+    quantity: float
+    entry_amount: float
+    entry_time: float
+    exit_time: float
+
+def _env_float(name, default, lo=-1.0, hi=1.0):
+    # Reject nan/inf and out-of-range values at startup instead of trading on them
+    value = float(os.getenv(name, default))
+    if not math.isfinite(value) or not lo <= value <= hi:
+        raise ValueError(f"{name}={value} must be a finite number between {lo} and {hi}")
+    return value
+
 API_KEY = os.getenv('BINANCE_API_KEY')
 API_SECRET = os.getenv('BINANCE_API_SECRET')
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
 TELEGRAM_CHAT_ID = os.getenv('TELEGRAM_CHAT_ID')
-FUNDING_RATE_THRESHOLD = float(os.getenv('FUNDING_RATE_THRESHOLD', '-0.003'))
-MINIMUM_BALANCE = float(os.getenv('MINIMUM_BALANCE', '10'))
-client = Client(API_KEY, API_SECRET)
+FUNDING_RATE_THRESHOLD = _env_float('FUNDING_RATE_THRESHOLD', '-0.003')
+MINIMUM_BALANCE = _env_float('MINIMUM_BALANCE', '10', lo=0.0, hi=1e9)
+STATE_DB_PATH = os.getenv('STATE_DB_PATH', 'bot_state.db')
+LOCK_FILE_PATH = os.getenv('LOCK_FILE_PATH', 'funding_bot.lock')
+BINANCE_TIMEOUT = (3, 10)
+# requests_params is applied to every REST call, so none can hang the scan loop
+client = Client(API_KEY, API_SECRET, requests_params={'timeout': BINANCE_TIMEOUT})
+
+# Point the futures REST client at a closer Binance host, e.g. when deployed near the matching engine
+BINANCE_FAPI_HOST = os.getenv('BINANCE_FAPI_HOST')
+if BINANCE_FAPI_HOST:
+    client.FUTURES_URL = f"https://{BINANCE_FAPI_HOST}/fapi"
+
+def _orjson_response_hook(response, *args, **kwargs):
+    # python-binance decodes every body via response.json(); orjson is several
+    # times faster on exchangeInfo/premiumIndex-sized payloads
+    content = response.content
+    response.json = lambda **kw: orjson.loads(content)
+
+if orjson is not None:
+    client.session.hooks['response'].append(_orjson_response_hook)
+
+WEIGHT_SOFT_LIMIT = 2000  # of Binance's 2400 request weight per minute
+_rate_limit = {'used_weight': 0, 'backoff_until': 0}
+
+def _rate_limit_hook(response, *args, **kwargs):
+    weight = response.headers.get('X-MBX-USED-WEIGHT-1M')
+    if weight is not None:
+        _rate_limit['used_weight'] = int(weight)
+    if response.status_code in (418, 429):
+        retry_after = int(response.headers.get('Retry-After', 60))
+        _rate_limit['backoff_until'] = max(_rate_limit['backoff_until'], time.time() + retry_after)
+
+client.session.hooks['response'].append(_rate_limit_hook)
+
+def _wait_for_rate_limit():
+    # Pause before another request if Binance asked us to back off or this minute's weight is nearly spent
+    now = time.time()
+    delay = _rate_limit['backoff_until'] - now
+    if _rate_limit['used_weight'] >= WEIGHT_SOFT_LIMIT:
+        delay = max(delay, 60 - now % 60)
+        _rate_limit['used_weight'] = 0
+    if delay > 0:
+        log.warning(f"Rate limit: backing off {delay:.1f}s")
+        time.sleep(delay)
 
 entry_data = {}
-recent_exits = {}
+recent_exits = OrderedDict()  # oldest exit first
+RECENT_EXIT_TTL = 600  # comfortably past the 5-min re-entry cooldown
+_interval_cache = {}
+_exchange_info_cache = {'ts': 0, 'data': None, 'symbol_info': {}, 'perpetuals': set()}
+EXCHANGE_INFO_TTL = int(os.getenv('EXCHANGE_INFO_TTL', '3600'))
+CACHE_TTL_ACCOUNT = 2
+CACHE_TTL_INTERVALS = 86400  # Binance occasionally moves a contract between 4h and 8h funding
+MAX_FETCH_WORKERS = 20
+SCAN_LEAD_SECONDS = 3060  # wake 51 min before funding, just ahead of the 50-min re-scan
+MAX_IDLE_SECONDS = 3600
+MIN_IDLE_SECONDS = 5
+POSITION_POLL_SECONDS = 30
+SMART_WAIT_TICK = 30
+SMART_WAIT_CHECK_EVERY = 300  # API health probe during long smart waits
+SMART_WAIT_RETRY_SECONDS = 5
+MARK_PRICE_STALE_SECONDS = 30
+STREAM_MIN_BACKOFF = 5
+STREAM_MAX_BACKOFF = 300
+ERROR_MIN_BACKOFF = 5
+ERROR_MAX_BACKOFF = 300
+CIRCUIT_BREAKER_THRESHOLD = 5  # consecutive failed cycles before alerts are muted
+# Fixed order parameters, bound once; call sites add only symbol and size
+MARKET_BUY_LONG = {'side': Client.SIDE_BUY, 'type': Client.ORDER_TYPE_MARKET, 'positionSide': 'LONG'}
+MARKET_SELL_LONG = {'side': Client.SIDE_SELL, 'type': Client.ORDER_TYPE_MARKET, 'positionSide': 'LONG'}
+STOP_LOSS_LONG = {'side': Client.SIDE_SELL, 'type': 'STOP_MARKET', 'closePosition': True, 'positionSide': 'LONG', 'workingType': 'MARK_PRICE'}
+# Bound str.format methods: the format spec is parsed once, not per line
+_RATE_PCT = "{:.4%}".format
+_SCAN_LINE = "{}: {} ({})\n".format
+DEFAULT_SYMBOL_INFO = {'min_qty': 0.001, 'step_size': Decimal('0.001'), 'tick_size': Decimal('0.01')}
 IST = pytz.timezone('Asia/Kolkata')
 
-def send_telegram_message(message: str):
-    print(f"[TELEGRAM] {message}")
-    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
+# Keep the TLS connection to Telegram alive between messages; only connection
+# failures are retried, since a retried POST after a 5xx could double-send
+_tg = requests.Session()
+_tg.mount('https://', HTTPAdapter(pool_connections=2, pool_maxsize=4, max_retries=Retry(total=2, connect=2, read=0, backoff_factor=0.15, status_forcelist=())))
+TELEGRAM_TIMEOUT = (3, 5)
+TELEGRAM_URL = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
+
+# requests keeps only 10 idle connections per host by default, so a 20-wide
+# fan-out kept opening fresh TLS sessions to fapi.binance.com. Transient
+# 5xx are retried for reads only; a retried order POST could fill twice.
+# 418/429 are left to _rate_limit_hook, and nothing is retried after a read
+# timeout since a signed GET resent with its old timestamp fails recvWindow
+client.session.mount('https://', HTTPAdapter(pool_connections=2, pool_maxsize=MAX_FETCH_WORKERS,
+                                             max_retries=Retry(total=3, read=0, backoff_factor=0.5, allowed_methods=['GET'],
+                                                               status_forcelist=[500, 502, 503, 504],
+                                                               raise_on_status=False)))
+_tg_q = queue.Queue(maxsize=1000)
+_wake_event = threading.Event()
+
+# Latest !markPrice@arr frame, kept in the same shape as premiumIndex rows
+_twm = None
+_mark_price_lock = threading.Lock()
+_mark_price_snapshot = {}
+_mark_price_ts = 0
+_stream_retry = {'socket': None, 'at': 0, 'backoff': STREAM_MIN_BACKOFF}
+
+# Open positions pushed by the user-data stream, keyed by (symbol, positionSide)
+_user_positions_lock = threading.Lock()
+_user_positions = {}
+_user_stream = {'socket': None, 'live': False, 'at': 0, 'seeded': 0}
+USER_STREAM_RETRY_SECONDS = 60
+USER_STREAM_RESEED_SECONDS = 300  # re-read positions over REST in case the stream dropped an update
+TELEGRAM_MAX_LEN = 4096
+TELEGRAM_BATCH_WINDOW = 2
+TELEGRAM_MIN_INTERVAL = 1  # Telegram allows about one message per second per chat
+_tg_last_post = {'at': 0}
+
+def ttl_cache(seconds):
+    # Memoize a read-only lookup for a few seconds; wrapper.cache_clear() drops it early
+    def decorator(fn):
+        cache = {}
+        lock = threading.Lock()
+        
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            key = (args, tuple(sorted(kwargs.items())))
+            now = time.monotonic()
+            with lock:
+                hit = cache.get(key)
+                if hit is not None and hit[1] > now:
+                    return hit[0]
+            value = fn(*args, **kwargs)
+            with lock:
+                cache[key] = (value, now + seconds)
+            return value
+        
+        def cache_clear():
+            with lock:
+                cache.clear()
+        
+        wrapper.cache_clear = cache_clear
+        return wrapper
+    return decorator
+
+def _post_telegram(message):
+    payload = {"chat_id": TELEGRAM_CHAT_ID, "text": message}
+    # sendMessage takes a JSON body; skip form-encoding the (often long) text
+    if orjson is not None:
+        body = {'data': orjson.dumps(payload), 'headers': {'Content-Type': 'application/json'}}
+    else:
+        body = {'json': payload}
     try:
-        requests.post(url, data={"chat_id": TELEGRAM_CHAT_ID, "text": message}, timeout=10)
+        for attempt in range(3):
+            # Pace posts ourselves rather than wait out a 429
+            delay = _tg_last_post['at'] + TELEGRAM_MIN_INTERVAL - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            _tg_last_post['at'] = time.monotonic()
+            resp = _tg.post(TELEGRAM_URL, timeout=TELEGRAM_TIMEOUT, **body)
+            if resp.status_code != 429:
+                return
+            # Telegram tells us how long to back off when rate limited
+            retry_after = resp.json().get('parameters', {}).get('retry_after', 1)
+            time.sleep(retry_after)
+        log.error("Telegram error: still rate limited, message dropped")
     except Exception as e:
-        print(f"Telegram error: {e}")
+        log.error(f"Telegram error: {e}")
+
+def _split_telegram(text):
+    chunks = []
+    while len(text) > TELEGRAM_MAX_LEN:
+        cut = text.rfind('\n', 0, TELEGRAM_MAX_LEN)
+        if cut <= 0:
+            cut = TELEGRAM_MAX_LEN
+        chunks.append(text[:cut])
+        text = text[cut:].lstrip('\n')
+    chunks.append(text)
+    return chunks
+
+def _telegram_worker():
+    while True:
+        urgent, message = _tg_q.get()
+        batch = [message]
+        
+        # Collect whatever else arrives within the batch window into one POST;
+        # an urgent message flushes the batch straight away
+        if not urgent:
+            deadline = time.time() + TELEGRAM_BATCH_WINDOW
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    urgent, message = _tg_q.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(message)
+                if urgent:
+                    break
+        
+        try:
+            for chunk in _split_telegram("\n\n".join(batch)):
+                _post_telegram(chunk)
+        finally:
+            for _ in batch:
+                _tg_q.task_done()
+
+def _flush_telegram(timeout=10):
+    deadline = time.time() + timeout
+    while _tg_q.unfinished_tasks and time.time() < deadline:
+        time.sleep(0.1)
+
+def send_telegram_message(message: str, urgent=False):
+    # Queue the message so the trading loop never waits on Telegram
+    log.info(f"[TELEGRAM] {message}")
+    while True:
+        try:
+            _tg_q.put_nowait((urgent, message))
+            return
+        except queue.Full:
+            # Drop the oldest pending message to make room
+            try:
+                _tg_q.get_nowait()
+                _tg_q.task_done()
+            except queue.Empty:
+                pass
+
+threading.Thread(target=_telegram_worker, name='telegram-sender', daemon=True).start()
+atexit.register(_flush_telegram)
+
+@ttl_cache(CACHE_TTL_ACCOUNT)
+def get_account_snapshot():
+    # One /fapi/v2/account call carries balances and positions together
+    return client.futures_account()
 
 def check_api_connection():
+    # An authenticated account read proves reachability and warms the snapshot
+    # that the balance and position checks right after it reuse
     try:
-        client.ping()
+        get_account_snapshot()
         return True
     except Exception as e:
-        print(f"[ERROR] API connection check failed: {e}")
+        log.error(f"API connection check failed: {e}")
         return False
 
 def get_wallet_equity():
     try:
-        acc = client.futures_account_balance()
+        acc = get_account_snapshot()['assets']
         usdt = next((x for x in acc if x['asset'] == 'USDT'), None)
         if usdt: 
-            return float(usdt['balance'])
+            return float(usdt['walletBalance'])
         else: 
             return 0.0
     except Exception as e:
         send_telegram_message(f"❌ Funds API error: {e}")
         return 0.0
 
+def _interval_from_next_funding(symbol, next_funding_ms):
+    # Trust a known interval while the next funding time sits on its grid. A time
+    # off the 00/08/16 UTC grid means a shorter interval: the largest of 4/2/1
+    # hours that fits. On the 8h grid every interval shares the same next funding
+    # time, so 8 still gives the right countdown.
+    hour = next_funding_ms // 3600000
+    cached = _cached_interval(symbol)
+    if cached and hour % cached == 0:
+        return cached
+    if hour % 8:
+        interval = next(h for h in (4, 2, 1) if hour % h == 0)
+        _interval_cache[symbol] = (interval, time.time() + CACHE_TTL_INTERVALS)
+        return interval
+    return 8
+
+def _cached_interval(symbol):
+    cached = _interval_cache.get(symbol)
+    if cached is not None and cached[1] > time.time():
+        return cached[0]
+    return None
+
 def get_funding_interval(symbol):
+    cached = _cached_interval(symbol)
+    if cached:
+        return cached
     try:
-        history = client.futures_funding_rate(symbol=symbol, limit=3)
-        if len(history) >= 2:
-            time_diff = (int(history[0]['fundingTime']) - int(history[1]['fundingTime'])) / 1000 / 3600
-            if time_diff <= 5:
-                return 4
-            else:
-                return 8
-        return 8
+        # Any streamed frame carries the symbol's funding grid; REST only without one
+        with _mark_price_lock:
+            premium_index = _mark_price_snapshot.get(symbol)
+        if premium_index is None:
+            premium_index = client.futures_mark_price(symbol=symbol)
+        return _interval_from_next_funding(symbol, int(premium_index['nextFundingTime']))
     except:
         return 8
 
-def get_symbol_info(symbol):
-    try:
-        info = client.futures_exchange_info()
+def quantize_down(value, step):
+    # Exact decimal floor onto the exchange's step grid; float division can
+    # land a hair under a multiple (0.3/0.1 = 2.9999999999999996) and lose a step
+    return float((Decimal(repr(value)) / step).to_integral_value(rounding=ROUND_DOWN) * step)
+
+def _parse_symbol_info(s):
+    min_qty = 0.001
+    step_size = Decimal('0.001')
+    tick_size = Decimal('0.01')
+    
+    for f in s['filters']:
+        if f['filterType'] == 'LOT_SIZE':
+            min_qty = float(f['minQty'])
+            step_size = Decimal(f['stepSize'])
+        
+        if f['filterType'] == 'PRICE_FILTER':
+            tick_size = Decimal(f['tickSize'])
+    
+    return {
+        'min_qty': min_qty,
+        'step_size': step_size,
+        'tick_size': tick_size
+    }
+
+def _get_exchange_info():
+    # exchangeInfo is ~1 MB and rarely changes, so parse it once per TTL
+    if _exchange_info_cache['data'] is None or time.time() - _exchange_info_cache['ts'] > EXCHANGE_INFO_TTL:
+        try:
+            info = client.futures_exchange_info()
+        except Exception as e:
+            # Contract metadata barely changes; a stale copy beats failing the scan
+            if _exchange_info_cache['data'] is None:
+                raise
+            log.error(f"Exchange info refresh failed, using cached copy: {e}")
+            return _exchange_info_cache
+        symbol_info = {}
+        perpetuals = set()
         for s in info['symbols']:
-            if s['symbol'] == symbol:
-                min_qty = 0.001
-                step_size = 0.001
-                precision = 3
-                price_precision = 2
-                
-                for f in s['filters']:
-                    if f['filterType'] == 'LOT_SIZE':
-                        min_qty = float(f['minQty'])
-                        step_size = float(f['stepSize'])
-                        
-                        # Calculate precision from stepSize
-                        step_str = f['stepSize'].rstrip('0')
-                        if '.' in step_str:
-                            precision = len(step_str.split('.')[1])
-                        else:
-                            precision = 0
-                    
-                    if f['filterType'] == 'PRICE_FILTER':
-                        tick_size = f['tickSize'].rstrip('0')
-                        if '.' in tick_size:
-                            price_precision = len(tick_size.split('.')[1])
-                        else:
-                            price_precision = 0
-                
-                return {
-                    'min_qty': min_qty,
-                    'step_size': step_size,
-                    'precision': precision,
-                    'price_precision': price_precision
-                }
+            symbol_info[s['symbol']] = _parse_symbol_info(s)
+            if s['contractType'] == 'PERPETUAL' and s['status'] == 'TRADING':
+                perpetuals.add(s['symbol'])
         
-        return {'min_qty': 0.001, 'step_size': 0.001, 'precision': 3, 'price_precision': 2}
+        _exchange_info_cache.update({
+            'ts': time.time(),
+            'data': info,
+            'symbol_info': symbol_info,
+            'perpetuals': perpetuals
+        })
+        _load_funding_info(perpetuals)
+    return _exchange_info_cache
+
+def _load_funding_info(symbols):
+    # /fapi/v1/fundingInfo lists only contracts whose funding settings were adjusted;
+    # everything else runs on the default 8h. One call sets every interval.
+    try:
+        rows = client._request_futures_api('get', 'fundingInfo')
+    except Exception as e:
+        log.error(f"Funding info unavailable, inferring intervals: {e}")
+        return
+    adjusted = {row['symbol']: int(row['fundingIntervalHours']) for row in rows}
+    expires = time.time() + CACHE_TTL_INTERVALS
+    for symbol in symbols:
+        _interval_cache[symbol] = (adjusted.get(symbol, 8), expires)
+
+def invalidate_exchange_info():
+    # Keep the stale copy as a fallback but force a refresh on the next lookup
+    _exchange_info_cache['ts'] = 0
+
+def get_symbol_info(symbol):
+    try:
+        return _get_exchange_info()['symbol_info'].get(symbol, DEFAULT_SYMBOL_INFO)
+    except Exception as e:
+        log.error(f"Symbol info: {e}")
+        return DEFAULT_SYMBOL_INFO
+
+def _on_mark_price(msg):
+    global _mark_price_ts
+    data = msg.get('data', msg) if isinstance(msg, dict) else msg
+    if not isinstance(data, list):
+        log.error(f"Mark price stream: {msg}")
+        return
+    
+    with _mark_price_lock:
+        for item in data:
+            _mark_price_snapshot[item['s']] = {
+                'symbol': item['s'],
+                'lastFundingRate': item['r'],
+                'nextFundingTime': item['T']
+            }
+        _mark_price_ts = time.time()
+    _stream_retry['backoff'] = STREAM_MIN_BACKOFF
+
+def start_market_streams():
+    global _twm
+    
+    # Don't try again until the backoff has passed, doubling it each attempt
+    _stream_retry['at'] = time.time() + _stream_retry['backoff']
+    _stream_retry['backoff'] = min(_stream_retry['backoff'] * 2, STREAM_MAX_BACKOFF)
+    try:
+        if _twm is None:
+            _twm = ThreadedWebsocketManager(api_key=API_KEY, api_secret=API_SECRET)
+            _twm.start()
+        elif _stream_retry['socket']:
+            _twm.stop_socket(_stream_retry['socket'])
+        _stream_retry['socket'] = _twm.start_all_mark_price_socket(callback=_on_mark_price, fast=True)
+    except Exception as e:
+        log.error(f"Mark price stream unavailable, using REST: {e}")
+        # Stop the manager before dropping it, or every retry leaks its thread
+        # along with any user socket it still hosts
+        if _twm is not None:
+            try:
+                _twm.stop()
+            except Exception as stop_err:
+                log.error(f"Stopping websocket manager: {stop_err}")
+        _twm = None
+        _stream_retry['socket'] = None
+        _user_stream['socket'] = None
+        _user_stream['live'] = False
+
+def _ensure_market_stream():
+    # Reconnect a stream that has gone quiet; REST covers the gap meanwhile
+    if time.time() >= _stream_retry['at']:
+        log.warning("Mark price stream stale, reconnecting")
+        start_market_streams()
+
+def _on_user_data(msg):
+    # Updates missed across an expiry or a reconnect are never replayed, so both
+    # drop back to REST until the stream is restarted and reseeded
+    if msg.get('e') in ('error', 'listenKeyExpired'):
+        log.error(f"User data stream: {msg}")
+        _user_stream['live'] = False
+        return
+    if msg.get('e') != 'ACCOUNT_UPDATE':
+        return
+    
+    with _user_positions_lock:
+        for p in msg['a']['P']:
+            amount = float(p['pa'])
+            if amount:
+                _user_positions[(p['s'], p['ps'])] = amount
+            else:
+                _user_positions.pop((p['s'], p['ps']), None)
+
+def start_user_stream():
+    # ACCOUNT_UPDATE pushes only changes, so seed from REST once the socket is up;
+    # python-binance keeps the listenKey alive
+    _user_stream['at'] = time.time() + USER_STREAM_RETRY_SECONDS
+    if _twm is None:
+        return
+    try:
+        if _user_stream['socket']:
+            _twm.stop_socket(_user_stream['socket'])
+        _user_stream['socket'] = _twm.start_futures_user_socket(callback=_on_user_data)
+        _seed_user_positions()
+        _user_stream['live'] = True
     except Exception as e:
-        print(f"[ERROR] Symbol info: {e}")
-        return {'min_qty': 0.001, 'step_size': 0.001, 'precision': 3, 'price_precision': 2}
+        log.error(f"User data stream unavailable, polling positions: {e}")
+        _user_stream['live'] = False
+
+def _seed_user_positions():
+    get_account_snapshot.cache_clear()
+    positions = get_positions()
+    with _user_positions_lock:
+        _user_positions.clear()
+        for p in positions:
+            if float(p['positionAmt']):
+                _user_positions[(p['symbol'], p['positionSide'])] = float(p['positionAmt'])
+    _user_stream['seeded'] = time.time()
+
+def _ensure_user_stream():
+    if not _user_stream['live']:
+        if time.time() >= _user_stream['at']:
+            start_user_stream()
+    elif time.time() - _user_stream['seeded'] >= USER_STREAM_RESEED_SECONDS:
+        try:
+            _seed_user_positions()
+        except Exception as e:
+            log.error(f"User stream reseed failed, polling positions: {e}")
+            _user_stream['live'] = False
+
+def _streamed_mark_prices():
+    with _mark_price_lock:
+        if time.time() - _mark_price_ts > MARK_PRICE_STALE_SECONDS:
+            return None
+        return list(_mark_price_snapshot.values())
+
+def _rate_limited(fn, symbol):
+    _wait_for_rate_limit()
+    return fn(symbol)
+
+def _fetch_concurrently(fn, symbols, max_workers=MAX_FETCH_WORKERS):
+    # Fan per-symbol REST calls out over a thread pool; failed lookups are skipped
+    results = {}
+    if not symbols:
+        return results
+    
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(symbols))) as ex:
+        futures = {ex.submit(_rate_limited, fn, symbol): symbol for symbol in symbols}
+        for fut in as_completed(futures):
+            try:
+                results[futures[fut]] = fut.result()
+            except Exception as e:
+                log.error(f"{futures[fut]}: {e}")
+    return results
 
 def fetch_funding_rates():
     try:
-        info = client.futures_exchange_info()
-        symbols = [s['symbol'] for s in info['symbols'] if s['contractType'] == 'PERPETUAL' and s['status'] == 'TRADING']
+        symbols = _get_exchange_info()['perpetuals']
+        
+        # Prefer the live stream; otherwise one premiumIndex call (no symbol) returns every contract
+        mark_prices = _streamed_mark_prices()
+        if mark_prices is None:
+            _ensure_market_stream()
+            try:
+                mark_prices = client.futures_mark_price()
+            except Exception as e:
+                log.error(f"Bulk premiumIndex failed, fetching per symbol: {e}")
+                mark_prices = _fetch_concurrently(lambda s: client.futures_mark_price(symbol=s), list(symbols)).values()
         
         rates = {}
-        for symbol in symbols:
+        for item in mark_prices:
+            symbol = item['symbol']
+            if symbol not in symbols:
+                continue
             try:
-                premium_index = client.futures_mark_price(symbol=symbol)
-                rate = float(premium_index['lastFundingRate'])
-                interval = get_funding_interval(symbol)
-                rates[symbol] = {'rate': rate, 'interval': interval}
+                rate = float(item['lastFundingRate'])
+                interval = _interval_from_next_funding(symbol, int(item['nextFundingTime']))
+                rates[symbol] = RateRow(rate, interval, _RATE_PCT(rate))
             except:
                 pass
         
@@ -122,27 +600,20 @@ def fetch_funding_rates():
         return {}
 
 def filter_eligible_symbols(rates, threshold):
-    return {sym: data for sym, data in rates.items() if data['rate'] <= threshold}
+    return {sym: data for sym, data in rates.items() if data.rate <= threshold}
 
-def seconds_to_next_funding(interval=8):
-    now_utc = datetime.now(timezone.utc)
-    
-    if interval == 4:
-        next_hour = ((now_utc.hour // 4) + 1) * 4
-    else:
-        next_hour = ((now_utc.hour // 8) + 1) * 8
-    
-    if next_hour >= 24:
-        next_funding_time = (now_utc + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
-    else:
-        next_funding_time = now_utc.replace(hour=next_hour, minute=0, second=0, microsecond=0)
+def seconds_to_next_funding(interval=8, now=None):
+    # Pass now (epoch seconds) to share one clock reading across a whole scan
+    if now is None:
+        now = time.time()
     
-    return (next_funding_time - now_utc).total_seconds()
+    # Funding runs on the UTC epoch grid, so a modulo handles day rollover
+    interval_sec = interval * 3600
+    return interval_sec - (now % interval_sec)
 
 def format_countdown(seconds):
-    hours = int(seconds // 3600)
-    minutes = int((seconds % 3600) // 60)
-    secs = int(seconds % 60)
+    hours, rem = divmod(int(seconds), 3600)
+    minutes, secs = divmod(rem, 60)
     
     if hours > 0:
         return f"{hours}h {minutes}m {secs}s"
@@ -152,320 +623,521 @@ def format_countdown(seconds):
         return f"{secs}s"
 
 def format_time_ist(timestamp):
-    dt_utc = datetime.fromtimestamp(timestamp, tz=timezone.utc)
+    # Only the minute is shown, so every timestamp within it shares one cached string
+    return _format_ist_minute(int(timestamp // 60))
+
+@functools.lru_cache(maxsize=512)
+def _format_ist_minute(minute):
+    dt_utc = datetime.fromtimestamp(minute * 60, tz=timezone.utc)
     dt_ist = dt_utc.astimezone(IST)
     return dt_ist.strftime("%I:%M %p IST")
 
-def find_nearest_funding_coin(eligible_coins):
+def annotate_countdowns(rates, now):
+    # Countdowns only depend on the interval, so compute each one once per scan
+    countdowns = {}
+    for data in rates.values():
+        interval = data.interval
+        if interval not in countdowns:
+            secs = seconds_to_next_funding(interval, now)
+            countdowns[interval] = (secs, format_countdown(secs))
+        data.sec_to_funding, data.countdown_str = countdowns[interval]
+    return rates
+
+def rescan_window(rates, threshold, min_s, max_s, now):
+    # Filter, countdown and window check in one pass over the fresh snapshot
+    countdowns = {}
+    for symbol, data in rates.items():
+        if data.rate > threshold:
+            continue
+        interval = data.interval
+        if interval not in countdowns:
+            secs = seconds_to_next_funding(interval, now)
+            countdowns[interval] = (secs, format_countdown(secs))
+        secs, countdown = countdowns[interval]
+        if min_s <= secs <= max_s:
+            data.sec_to_funding, data.countdown_str = secs, countdown
+            yield symbol, data
+
+def find_nearest_funding_coin(eligible_coins, now=None):
     if not eligible_coins:
         return None
     
-    # Calculate funding times for all coins
-    coins_with_time = []
-    for symbol, data in eligible_coins.items():
-        time_left = seconds_to_next_funding(data['interval'])
-        coins_with_time.append((symbol, data, time_left))
-    
-    # Find the minimum funding time
-    min_time = min(coins_with_time, key=lambda x: x[2])[2]
+    if now is None:
+        now = time.time()
     
-    # Filter coins within 3 seconds of minimum time
-    nearest_coins = [
-        (symbol, data, time_left) 
-        for symbol, data, time_left in coins_with_time 
-        if abs(time_left - min_time) <= 3
-    ]
+    # One pass: countdowns only depend on the interval, and coins whose funding
+    # lands within 3 seconds of each other are settled by the more negative rate
+    times = {}
+    best = None
+    for symbol, data in eligible_coins.items():
+        interval = data.interval
+        if interval not in times:
+            times[interval] = seconds_to_next_funding(interval, now)
+        time_left = times[interval]
+        if best is None or time_left < best[2] - 3 or (abs(time_left - best[2]) <= 3 and data.rate < best[1].rate):
+            best = (symbol, data, time_left)
     
-    # If multiple coins are within 3 seconds, pick most negative
-    if len(nearest_coins) > 1:
-        most_negative = min(nearest_coins, key=lambda x: x[1]['rate'])
-        return most_negative
-    else:
-        # Only one coin in nearest window, return it
-        return nearest_coins[0]
+    return best
+
+def get_positions():
+    return get_account_snapshot()['positions']
+
+def get_long_positions():
+    return [p for p in get_positions() if p['positionSide'] == 'LONG' and float(p['positionAmt']) > 0]
 
 def position_exists():
+    # Gates new entries, so always read the account rather than trust the stream;
+    # the scan right after reuses the same cached snapshot for the balance
     try:
-        positions = client.futures_position_information()
-        return any(float(p['positionAmt']) != 0 for p in positions)
+        return any(float(p['positionAmt']) != 0 for p in get_positions())
+    except:
+        return True
+
+def position_exists_for(symbol):
+    # Only a streamed "open" is trusted; a missing position is confirmed over REST
+    # before the caller treats the trade as closed
+    if _user_stream['live']:
+        with _user_positions_lock:
+            if any(key[0] == symbol for key in _user_positions):
+                return True
+    # positionRisk?symbol= returns one row instead of the whole account
+    try:
+        return any(float(p['positionAmt']) != 0 for p in client.futures_position_information(symbol=symbol))
     except:
         return True
 
 def recently_exited(symbol, cooldown_minutes=5):
-    global recent_exits
-    if symbol in recent_exits:
-        elapsed = (datetime.now().timestamp() - recent_exits[symbol]) / 60
-        if elapsed < cooldown_minutes:
-            return True
-    return False
-
-def place_long_position(symbol, capital, rate):
+    # Exit stamps are monotonic so an NTP step can't shorten or extend the cooldown
+    return time.monotonic() - recent_exits.get(symbol, -math.inf) < cooldown_minutes * 60
+
+# Open trades and exit cooldowns survive a restart; only the main loop writes here.
+# Opened by load_state so importing the module leaves no files behind
+_state_db = None
+
+def load_state():
+    global _state_db
+    _state_db = sqlite3.connect(STATE_DB_PATH, check_same_thread=False)
+    _state_db.execute("PRAGMA journal_mode=WAL")
+    _state_db.execute("CREATE TABLE IF NOT EXISTS trades (symbol TEXT PRIMARY KEY, entry_price REAL, quantity REAL, entry_amount REAL, entry_time REAL, exit_time REAL)")
+    _state_db.execute("CREATE TABLE IF NOT EXISTS exits (symbol TEXT PRIMARY KEY, exit_ts REAL)")
+    _state_db.commit()
+    
+    for symbol, *fields in _state_db.execute("SELECT symbol, entry_price, quantity, entry_amount, entry_time, exit_time FROM trades"):
+        entry_data[symbol] = EntryRecord(*fields)
+    # Cooldowns are kept monotonic in memory but stored as wall-clock time
+    offset = time.monotonic() - time.time()
+    for symbol, exit_ts in _state_db.execute("SELECT symbol, exit_ts FROM exits WHERE exit_ts > ? ORDER BY exit_ts",
+                                             (time.time() - RECENT_EXIT_TTL,)):
+        recent_exits[symbol] = exit_ts + offset
+
+def save_entry(symbol, record):
+    entry_data[symbol] = record
+    try:
+        with _state_db:
+            _state_db.execute("INSERT OR REPLACE INTO trades VALUES (?, ?, ?, ?, ?, ?)",
+                              (symbol, record.entry_price, record.quantity, record.entry_amount, record.entry_time, record.exit_time))
+    except sqlite3.Error as e:
+        log.error(f"Saving entry for {symbol}: {e}")
+
+def save_exit(symbol):
+    now = time.monotonic()
+    recent_exits[symbol] = now
+    recent_exits.move_to_end(symbol)
+    # Stamps are in insertion order, so expired cooldowns sit at the front
+    while next(iter(recent_exits.values())) < now - RECENT_EXIT_TTL:
+        recent_exits.popitem(last=False)
+    entry_data.pop(symbol, None)
+    try:
+        with _state_db:
+            _state_db.execute("DELETE FROM trades WHERE symbol = ?", (symbol,))
+            _state_db.execute("INSERT OR REPLACE INTO exits VALUES (?, ?)", (symbol, time.time()))
+            _state_db.execute("DELETE FROM exits WHERE exit_ts < ?", (time.time() - RECENT_EXIT_TTL,))
+    except sqlite3.Error as e:
+        log.error(f"Saving exit for {symbol}: {e}")
+
+class OrderRejected(Exception):
+    def __init__(self, code, msg):
+        super().__init__(f"{msg} (code {code})")
+        self.code = code
+
+def _open_long_with_stop(symbol, quantity, stop_price):
+    # Entry and stop loss go out in one signed batchOrders request so the position is never
+    # unprotected for a round-trip. Returns (entry, stop); stop is None if that leg failed.
+    # batchOrders takes every value as a string, hence 'true' rather than True.
+    legs = [
+        {**MARKET_BUY_LONG, 'symbol': symbol, 'quantity': str(quantity)},
+        {**STOP_LOSS_LONG, 'closePosition': 'true', 'symbol': symbol, 'stopPrice': str(stop_price)}
+    ]
+    try:
+        entry, stop = client.futures_place_batch_order(batchOrders=legs)
+    except Exception as e:
+        # Only fall back on a 4xx rejection of the whole batch. Transport errors, 5xx and
+        # -1006/-1007 (execution status unknown) may still have filled, so never resend those
+        status = getattr(e, 'status_code', None)
+        if status is None or status >= 500 or getattr(e, 'code', None) in (-1006, -1007):
+            raise
+        log.error(f"Batch order rejected, placing entry alone: {e}")
+        return client.futures_create_order(symbol=symbol, quantity=quantity, **MARKET_BUY_LONG), None
+    
+    if 'code' in entry:
+        if 'orderId' in stop:
+            client.futures_cancel_order(symbol=symbol, orderId=stop['orderId'])
+        raise OrderRejected(entry['code'], entry.get('msg'))
+    if 'code' in stop:
+        log.error(f"Stop loss leg rejected: {stop.get('msg')}")
+        return entry, None
+    return entry, stop
+
+def place_long_position(symbol, capital, rate, interval):
     global entry_data
     
     try:
-        if not check_api_connection():
-            send_telegram_message(f"❌ TRADE CANCELED: API connection lost")
-            return
-        
-        ticker = client.futures_symbol_ticker(symbol=symbol)
-        price = float(ticker['price'])
+        # Fetch the price and symbol filters (an exchangeInfo refresh if the cache is
+        # due) while the account snapshot that backs every validation below loads
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            ticker_future = pool.submit(client.futures_symbol_ticker, symbol=symbol)
+            info_future = pool.submit(get_symbol_info, symbol)
+            if not check_api_connection():
+                send_telegram_message(f"❌ TRADE CANCELED: API connection lost", urgent=True)
+                return
+            price = float(ticker_future.result()['price'])
+            symbol_info = info_future.result()
         
         if price <= 0:
-            send_telegram_message(f"❌ TRADE CANCELED: Invalid price for {symbol}")
+            send_telegram_message(f"❌ TRADE CANCELED: Invalid price for {symbol}", urgent=True)
             return
         
-        symbol_info = get_symbol_info(symbol)
         min_qty = symbol_info['min_qty']
-        precision = symbol_info['precision']
-        price_precision = symbol_info['price_precision']
         
-        # Calculate quantity with correct precision
-        quantity = round(capital / price, precision)
+        # Snap to LOT_SIZE/PRICE_FILTER steps so Binance doesn't reject the order
+        quantity = quantize_down(capital / price, symbol_info['step_size'])
         
         if quantity < min_qty:
-            send_telegram_message(f"❌ TRADE CANCELED: Quantity {quantity} below minimum {min_qty}")
+            send_telegram_message(f"❌ TRADE CANCELED: Quantity {quantity} below minimum {min_qty}", urgent=True)
             return
         
-        # Calculate stop loss with PRICE precision
-        stop_loss_price = round(price * 0.90, price_precision)
+        stop_loss_price = quantize_down(price * 0.90, symbol_info['tick_size'])
         amount = round(price * quantity, 2)
-        interval = get_funding_interval(symbol)
         
         # Calculate times
-        now = datetime.now().timestamp()
+        now = time.time()
         exit_seconds = seconds_to_next_funding(interval) - 60
         exit_time = now + exit_seconds
         hold_duration = exit_seconds / 60
         
         # Pre-entry alert
-        pre_msg = f"⚠️ PREPARING TO ENTER LONG\n\n"
-        pre_msg += f"Coin: {symbol}\n"
-        pre_msg += f"Funding Rate: {100*rate:.4f}%\n"
-        pre_msg += f"Price: ${price}\n"
-        pre_msg += f"Quantity: {quantity}\n"
-        pre_msg += f"Amount: ${amount} USDT\n"
-        pre_msg += f"Stop Loss: ${stop_loss_price}\n"
-        pre_msg += f"Entry Time: {format_time_ist(now)}\n"
-        pre_msg += f"Exit Time: {format_time_ist(exit_time)}\n"
-        pre_msg += f"Hold Duration: ~{int(hold_duration)} minutes\n\n"
-        pre_msg += f"🔄 Running final validations..."
-        send_telegram_message(pre_msg)
-        
-        time.sleep(2)
+        pre_msg = "".join([
+            f"⚠️ PREPARING TO ENTER LONG\n\n",
+            f"Coin: {symbol}\n",
+            f"Funding Rate: {_RATE_PCT(rate)}\n",
+            f"Price: ${price}\n",
+            f"Quantity: {quantity}\n",
+            f"Amount: ${amount} USDT\n",
+            f"Stop Loss: ${stop_loss_price}\n",
+            f"Entry Time: {format_time_ist(now)}\n",
+            f"Exit Time: {format_time_ist(exit_time)}\n",
+            f"Hold Duration: ~{int(hold_duration)} minutes\n\n",
+            f"🔄 Running final validations..."
+        ])
+        send_telegram_message(pre_msg, urgent=True)
         
         if position_exists():
-            send_telegram_message(f"❌ TRADE CANCELED: Active position found")
+            send_telegram_message(f"❌ TRADE CANCELED: Active position found", urgent=True)
             return
         
         final_balance = get_wallet_equity()
         if final_balance < MINIMUM_BALANCE:
-            send_telegram_message(f"❌ TRADE CANCELED: Balance ${final_balance} below ${MINIMUM_BALANCE}")
+            send_telegram_message(f"❌ TRADE CANCELED: Balance ${final_balance} below ${MINIMUM_BALANCE}", urgent=True)
             return
         
         if recently_exited(symbol):
-            send_telegram_message(f"❌ TRADE CANCELED: {symbol} in cooldown (5 min)")
+            send_telegram_message(f"❌ TRADE CANCELED: {symbol} in cooldown (5 min)", urgent=True)
             return
         
         confirm_msg = f"✅ ALL CHECKS PASSED\n🚀 Entering position NOW..."
-        send_telegram_message(confirm_msg)
+        send_telegram_message(confirm_msg, urgent=True)
         
-        order = client.futures_create_order(
-            symbol=symbol,
-            side=Client.SIDE_BUY,
-            type=Client.ORDER_TYPE_MARKET,
-            quantity=quantity,
-            positionSide='LONG'
-        )
+        order, sl_order = _open_long_with_stop(symbol, quantity, stop_loss_price)
+        get_account_snapshot.cache_clear()
         
-        entry_data[symbol] = {
-            'entry_price': price,
-            'quantity': quantity,
-            'entry_amount': amount,
-            'entry_time': now,
-            'exit_time': exit_time
-        }
+        save_entry(symbol, EntryRecord(price, quantity, amount, now, exit_time))
         
-        entry_msg = f"✅ LONG OPENED: {symbol}\n"
-        entry_msg += f"Order ID: {order['orderId']}\n"
-        entry_msg += f"Entry: {format_time_ist(now)}\n"
-        entry_msg += f"Exit: {format_time_ist(exit_time)}\n"
-        entry_msg += f"Hold: ~{int(hold_duration)} min"
-        send_telegram_message(entry_msg)
+        entry_msg = "".join([
+            f"✅ LONG OPENED: {symbol}\n",
+            f"Order ID: {order['orderId']}\n",
+            f"Entry: {format_time_ist(now)}\n",
+            f"Exit: {format_time_ist(exit_time)}\n",
+            f"Hold: ~{int(hold_duration)} min"
+        ])
+        send_telegram_message(entry_msg, urgent=True)
         
-        # Set 10% stop loss
-        try:
-            sl_order = client.futures_create_order(
-                symbol=symbol,
-                side=Client.SIDE_SELL,
-                type='STOP_MARKET',
-                stopPrice=stop_loss_price,
-                closePosition=True,
-                positionSide='LONG',
-                workingType='MARK_PRICE'
-            )
-            send_telegram_message(f"✅ STOP LOSS SET: ${stop_loss_price}")
-        except Exception as sl_error:
-            send_telegram_message(f"❌ Stop loss error: {sl_error}\nPosition open but no SL!")
+        # Set 10% stop loss on its own if it didn't go out with the entry
+        if sl_order is None:
+            try:
+                sl_order = client.futures_create_order(symbol=symbol, stopPrice=stop_loss_price, **STOP_LOSS_LONG)
+            except Exception as sl_error:
+                send_telegram_message(f"❌ Stop loss error: {sl_error}\nPosition open but no SL!", urgent=True)
+        if sl_order is not None:
+            send_telegram_message(f"✅ STOP LOSS SET: ${stop_loss_price}", urgent=True)
         
     except Exception as e:
-        send_telegram_message(f"❌ Trade error: {e}")
+        # -1121 Invalid symbol: the contract was delisted since the last exchangeInfo refresh
+        if getattr(e, 'code', None) == -1121:
+            invalidate_exchange_info()
+        send_telegram_message(f"❌ Trade error: {e}", urgent=True)
 
 def square_off_all():
     global entry_data, recent_exits
     
     try:
-        positions = client.futures_position_information()
-        for position in positions:
-            if position['positionSide'] == 'LONG' and float(position['positionAmt']) > 0:
-                amt = abs(float(position['positionAmt']))
-                sym = position['symbol']
-                
-                ticker = client.futures_symbol_ticker(symbol=sym)
-                exit_price = float(ticker['price'])
-                
-                entry_price = entry_data.get(sym, {}).get('entry_price', exit_price)
-                entry_amount = entry_data.get(sym, {}).get('entry_amount', 0)
-                entry_time = entry_data.get(sym, {}).get('entry_time', datetime.now().timestamp())
-                
-                exit_time = datetime.now().timestamp()
-                hold_duration = (exit_time - entry_time) / 60
-                
-                pre_msg = f"⏰ CLOSING POSITION (1 min left)\n\n"
-                pre_msg += f"Coin: {sym}\n"
-                pre_msg += f"Entry: ${entry_price}\n"
-                pre_msg += f"Current: ${exit_price}\n"
-                pre_msg += f"Quantity: {amt}\n\n"
-                pre_msg += f"Closing in 3 seconds..."
-                send_telegram_message(pre_msg)
-                
-                time.sleep(3)
-                
-                close_order = client.futures_create_order(
-                    symbol=sym,
-                    side=Client.SIDE_SELL,
-                    type=Client.ORDER_TYPE_MARKET,
-                    quantity=str(amt),
-                    positionSide='LONG'
-                )
-                
-                exit_amount = round(exit_price * amt, 2)
-                pnl_usdt = round(exit_amount - entry_amount, 2)
-                pnl_percent = round((pnl_usdt / entry_amount) * 100, 2) if entry_amount > 0 else 0
-                final_balance = get_wallet_equity()
-                
-                exit_msg = f"✅ POSITION CLOSED: {sym}\n\n"
-                exit_msg += f"Position held: {int(hold_duration)} minutes\n"
-                exit_msg += f"Entry Time: {format_time_ist(entry_time)}\n"
-                exit_msg += f"Exit Time: {format_time_ist(exit_time)}\n\n"
-                exit_msg += f"📊 TRADE SUMMARY:\n"
-                exit_msg += f"Entry: ${entry_price}\n"
-                exit_msg += f"Exit: ${exit_price}\n"
-                exit_msg += f"Quantity: {amt}\n"
-                exit_msg += f"Entry Amount: ${entry_amount}\n"
-                exit_msg += f"Exit Amount: ${exit_amount}\n\n"
-                
-                if pnl_usdt >= 0:
-                    exit_msg += f"💰 P&L: +${pnl_usdt} (+{pnl_percent}%)\n✅ Profit\n\n"
-                else:
-                    exit_msg += f"📉 P&L: ${pnl_usdt} ({pnl_percent}%)\n❌ Loss\n\n"
-                
-                exit_msg += f"Balance: ${final_balance}"
-                send_telegram_message(exit_msg)
-                
-                recent_exits[sym] = datetime.now().timestamp()
+        longs = get_long_positions()
+        
+        # Fetch every exit price at once instead of one round-trip per position
+        prices = _fetch_concurrently(lambda s: float(client.futures_symbol_ticker(symbol=s)['price']), [p['symbol'] for p in longs])
+        
+        for position in longs:
+            amt = abs(float(position['positionAmt']))
+            sym = position['symbol']
+            
+            if sym in prices:
+                exit_price = prices[sym]
+            else:
+                exit_price = float(client.futures_symbol_ticker(symbol=sym)['price'])
+            
+            exit_time = time.time()
+            rec = entry_data.get(sym)
+            if rec:
+                entry_price, entry_amount, entry_time = rec.entry_price, rec.entry_amount, rec.entry_time
+            else:
+                # Position we didn't open (or lost track of)
+                entry_price, entry_amount, entry_time = exit_price, 0, exit_time
+            
+            hold_duration = (exit_time - entry_time) / 60
+            
+            pre_msg = "".join([
+                f"⏰ CLOSING POSITION (1 min left)\n\n",
+                f"Coin: {sym}\n",
+                f"Entry: ${entry_price}\n",
+                f"Current: ${exit_price}\n",
+                f"Quantity: {amt}\n\n",
+                f"Closing now..."
+            ])
+            send_telegram_message(pre_msg, urgent=True)
+            
+            close_order = client.futures_create_order(symbol=sym, quantity=str(amt), **MARKET_SELL_LONG)
+            get_account_snapshot.cache_clear()
+            
+            exit_amount = round(exit_price * amt, 2)
+            pnl_usdt = round(exit_amount - entry_amount, 2)
+            pnl_percent = round((pnl_usdt / entry_amount) * 100, 2) if entry_amount > 0 else 0
+            final_balance = get_wallet_equity()
+            if pnl_usdt >= 0:
+                pnl_icon, pnl_sign, pnl_label = "💰", "+", "✅ Profit"
+            else:
+                pnl_icon, pnl_sign, pnl_label = "📉", "", "❌ Loss"
+            
+            exit_msg = "".join([
+                f"✅ POSITION CLOSED: {sym}\n\n",
+                f"Position held: {int(hold_duration)} minutes\n",
+                f"Entry Time: {format_time_ist(entry_time)}\n",
+                f"Exit Time: {format_time_ist(exit_time)}\n\n",
+                f"📊 TRADE SUMMARY:\n",
+                f"Entry: ${entry_price}\n",
+                f"Exit: ${exit_price}\n",
+                f"Quantity: {amt}\n",
+                f"Entry Amount: ${entry_amount}\n",
+                f"Exit Amount: ${exit_amount}\n\n",
+                f"{pnl_icon} P&L: {pnl_sign}${pnl_usdt} ({pnl_sign}{pnl_percent}%)\n{pnl_label}\n\n",
+                f"Balance: ${final_balance}"
+            ])
+            send_telegram_message(exit_msg, urgent=True)
+            
+            save_exit(sym)
                 
-                if sym in entry_data:
-                    del entry_data[sym]
-                    
     except Exception as e:
-        send_telegram_message(f"❌ Close error: {e}")
+        send_telegram_message(f"❌ Close error: {e}", urgent=True)
 
 def track_pnl():
     try:
-        income = client.futures_income_history(incomeType='FUNDING_FEE', limit=100)
-        total = sum(float(x['income']) for x in income)
-        count = len([x for x in income if float(x['income']) != 0])
-        last_24h = sum(float(x['income']) for x in income if (time.time() - int(x['time'])/1000) <= 86400)
+        # The server trims to the last 24h, so every row returned counts
+        income = client.futures_income_history(incomeType='FUNDING_FEE',
+                                               startTime=int((time.time() - 86400) * 1000), limit=1000)
+        last_24h = 0.0
+        count = 0
+        for x in income:
+            amount = float(x['income'])
+            last_24h += amount
+            if amount != 0:
+                count += 1
         
-        msg = f"💰 Funding P&L:\n"
-        msg += f"Total: ${total:.4f}\n"
-        msg += f"24h: ${last_24h:.4f}\n"
-        msg += f"Payments: {count}"
+        msg = "".join([
+            f"💰 Funding P&L:\n",
+            f"24h: ${last_24h:.4f}\n",
+            f"Payments: {count}"
+        ])
         send_telegram_message(msg)
     except Exception as e:
-        print(f"[ERROR] P&L: {e}")
+        log.error(f"P&L: {e}")
+
+def compute_next_wakeup():
+    now = time.time()
+    
+    # Every 8h funding boundary is also a 4h one, so the 4h grid covers both
+    until_scan = seconds_to_next_funding(4) - SCAN_LEAD_SECONDS
+    if until_scan <= 0:
+        until_scan += 4 * 3600
+    wakeup = min(MAX_IDLE_SECONDS, until_scan)
+    
+    # Never sleep through a planned exit
+    for rec in entry_data.values():
+        wakeup = min(wakeup, rec.exit_time - now)
+    
+    return max(MIN_IDLE_SECONDS, wakeup)
+
+def interruptible_sleep(total, check=None, check_every=SMART_WAIT_CHECK_EVERY, tick=SMART_WAIT_TICK):
+    # Sleep in short ticks so a long wait can be abandoned; check() is polled at
+    # most every check_every seconds and returning True aborts the wait
+    end = time.monotonic() + total
+    next_check = time.monotonic() + check_every
+    while (remaining := end - time.monotonic()) > 0:
+        if check is not None and time.monotonic() >= next_check:
+            if check():
+                return False
+            next_check = time.monotonic() + check_every
+        time.sleep(min(tick, remaining))
+    return True
+
+def _api_unreachable():
+    # Each probe is a fresh signed account read; one failure is often a blip,
+    # so retry once before abandoning a planned entry
+    if check_api_connection():
+        return False
+    time.sleep(SMART_WAIT_RETRY_SECONDS)
+    return not check_api_connection()
+
+def _wake_on_signal(signum, frame):
+    _wake_event.set()
+
+_failures = {'streak': 0}
+
+def _back_off_after_failure(message):
+    # Exponential backoff across consecutive failed cycles, never shorter than a
+    # Binance 418/429 Retry-After; past the threshold only the first alert is sent
+    _failures['streak'] += 1
+    streak = _failures['streak']
+    delay = min(ERROR_MIN_BACKOFF * 2 ** (streak - 1), ERROR_MAX_BACKOFF)
+    delay = max(delay, _rate_limit['backoff_until'] - time.time())
+    message = f"{message} - retrying in {int(delay)}s"
+    if streak < CIRCUIT_BREAKER_THRESHOLD:
+        send_telegram_message(message)
+    elif streak == CIRCUIT_BREAKER_THRESHOLD:
+        send_telegram_message(f"{message}\n🛑 {streak} failures in a row - muting alerts until recovery")
+    else:
+        log.warning(message)
+    time.sleep(delay)
+
+def _reset_failures():
+    if _failures['streak'] >= CIRCUIT_BREAKER_THRESHOLD:
+        send_telegram_message(f"✅ Recovered after {_failures['streak']} failed cycles")
+    _failures['streak'] = 0
+
+_instance_lock = None
+
+def acquire_instance_lock():
+    # Two bots on one account would double every entry and exit
+    global _instance_lock
+    if fcntl is None:
+        return True
+    # 'a+' so a losing second launch doesn't truncate the holder's PID
+    lock_file = open(LOCK_FILE_PATH, 'a+')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    lock_file.seek(0)
+    lock_file.truncate()
+    lock_file.write(str(os.getpid()))
+    lock_file.flush()
+    # Held open for the life of the process; the OS drops the lock on exit
+    _instance_lock = lock_file
+    return True
 
 def run_bot():
+    load_state()
+    start_market_streams()
+    start_user_stream()
     send_telegram_message("🚦 Bot started!\n✅ 4h & 8h funding\n✅ Smart scan logic\n✅ Auto-exit at 1 min\n✅ IST timezone")
     last_report = time.time()
     
     while True:
         try:
-            # Check if position exists and handle exit
-            if position_exists():
-                positions = client.futures_position_information()
-                for position in positions:
-                    if position['positionSide'] == 'LONG' and float(position['positionAmt']) > 0:
-                        sym = position['symbol']
-                        
-                        # Get exit time from entry_data
-                        if sym in entry_data and 'exit_time' in entry_data[sym]:
-                            exit_time = entry_data[sym]['exit_time']
-                            current_time = datetime.now().timestamp()
-                            time_until_exit = exit_time - current_time
-                            
-                            if time_until_exit <= 0:
-                                # Exit time reached or passed
-                                square_off_all()
-                                break
-                            else:
-                                # Sleep until exit time
-                                print(f"Position active. Exiting in {int(time_until_exit)} seconds...")
-                                time.sleep(min(60, time_until_exit))
-                                continue
-                        else:
-                            # Fallback: check based on funding time
-                            interval = get_funding_interval(sym)
-                            if 0 < seconds_to_next_funding(interval) <= 60:
-                                square_off_all()
-                                break
+            _ensure_user_stream()
+            
+            # Trades we opened are polled per symbol; the full account read only
+            # runs when none are tracked
+            held = []
+            for sym in list(entry_data):
+                if position_exists_for(sym):
+                    held.append(sym)
+                else:
+                    # Closed outside the bot, e.g. the stop loss fired
+                    save_exit(sym)
+            
+            if held or position_exists():
+                next_check = POSITION_POLL_SECONDS
+                for sym in held or [p['symbol'] for p in get_long_positions()]:
+                    # Get exit time from entry_data
+                    if sym in entry_data:
+                        time_until_exit = entry_data[sym].exit_time - time.time()
+                    else:
+                        # Fallback: exit 1 min before funding
+                        time_until_exit = seconds_to_next_funding(get_funding_interval(sym)) - 60
+                    
+                    if time_until_exit <= 0:
+                        # Exit time reached or passed
+                        square_off_all()
+                        break
+                    
+                    log.info(f"Position active. {sym} exits in {int(time_until_exit)} seconds...")
+                    next_check = min(next_check, time_until_exit)
                 
-                # If position still exists, wait before next check
-                time.sleep(30)
+                _reset_failures()
+                # Wake exactly at the earliest exit rather than polling past it
+                time.sleep(max(1, next_check))
                 continue
             
             # No position - scan for entry opportunities
-            now_str = datetime.now(IST).strftime("%d-%m-%Y %I:%M:%S %p IST")
-            
             if not check_api_connection():
-                send_telegram_message("⚠️ API issue - retrying in 1 min")
-                time.sleep(60)
+                _back_off_after_failure("⚠️ API issue")
                 continue
+            _reset_failures()
             
             rates = fetch_funding_rates()
             eligible = filter_eligible_symbols(rates, FUNDING_RATE_THRESHOLD)
             
+            # One clock reading for every countdown in this scan
+            now = time.time()
+            now_str = datetime.fromtimestamp(now, tz=IST).strftime("%d-%m-%Y %I:%M:%S %p IST")
+            annotate_countdowns(rates, now)
+            
             # Build scan message
-            msg = f"🔍 Scan [{now_str}]\n\n"
+            msg_parts = [f"🔍 Scan [{now_str}]\n\n"]
             
             if not eligible:
-                negative_rates = sorted(rates.items(), key=lambda x: x[1]['rate'])[:10]
-                msg += f"❌ No coins below -0.3%\n\nTop 10:\n"
-                for sym, data in negative_rates:
-                    countdown = format_countdown(seconds_to_next_funding(data['interval']))
-                    msg += f"{sym}: {100*data['rate']:.4f}% ({countdown})\n"
+                negative_rates = heapq.nsmallest(10, rates.items(), key=lambda x: x[1].rate)
+                msg_parts.append(f"❌ No coins below -0.3%\n\nTop 10:\n")
+                msg_parts.extend(_SCAN_LINE(sym, data.rate_pct_str, data.countdown_str) for sym, data in negative_rates)
             else:
-                sorted_eligible = sorted(eligible.items(), key=lambda x: x[1]['rate'])
-                msg += f"✅ {len(eligible)} coins below -0.3%:\n\n"
-                for sym, data in sorted_eligible[:10]:
-                    countdown = format_countdown(seconds_to_next_funding(data['interval']))
-                    msg += f"{sym}: {100*data['rate']:.4f}% ({countdown})\n"
+                sorted_eligible = heapq.nsmallest(10, eligible.items(), key=lambda x: x[1].rate)
+                msg_parts.append(f"✅ {len(eligible)} coins below -0.3%:\n\n")
+                msg_parts.extend(_SCAN_LINE(sym, data.rate_pct_str, data.countdown_str) for sym, data in sorted_eligible)
             
-            send_telegram_message(msg)
+            send_telegram_message("".join(msg_parts))
             
             # Smart entry logic
             if eligible:
-                nearest = find_nearest_funding_coin(eligible)
+                nearest = find_nearest_funding_coin(eligible, now)
                 if nearest:
                     symbol, data, time_left = nearest
                     time_left_minutes = time_left / 60
@@ -481,11 +1153,13 @@ def run_bot():
                             send_telegram_message(f"⚠️ Balance: ${current_balance} (below ${MINIMUM_BALANCE})")
                         else:
                             # Activate SMART WAIT
-                            wait_msg = f"⚠️ SMART SCAN DETECTED!\n\n"
-                            wait_msg += f"Current time left: {format_countdown(time_left)}\n"
-                            wait_msg += f"Next scan would have: {format_countdown(max(0, next_scan_time_left))}\n"
-                            wait_msg += f"❌ Next scan < 45 min - TRADE WOULD BE MISSED!\n\n"
-                            wait_msg += f"✅ ACTIVATING SMART WAIT NOW!"
+                            wait_msg = "".join([
+                                f"⚠️ SMART SCAN DETECTED!\n\n",
+                                f"Current time left: {format_countdown(time_left)}\n",
+                                f"Next scan would have: {format_countdown(max(0, next_scan_time_left))}\n",
+                                f"❌ Next scan < 45 min - TRADE WOULD BE MISSED!\n\n",
+                                f"✅ ACTIVATING SMART WAIT NOW!"
+                            ])
                             send_telegram_message(wait_msg)
                             
                             # Calculate wait time to 50-min mark
@@ -493,56 +1167,54 @@ def run_bot():
                                 wait_time = time_left - 3000  # Wait until 50-min mark
                                 wait_minutes = wait_time / 60
                                 
-                                now = datetime.now().timestamp()
+                                now = time.time()
                                 rescan_time = now + wait_time  # 50 min mark
                                 entry_time = rescan_time + 300  # 45 min mark
                                 exit_time = now + time_left - 60
                                 hold_duration = (time_left - 120) / 60
                                 
-                                smart_msg = f"📊 SMART WAIT PLAN:\n\n"
-                                smart_msg += f"Most negative: {symbol} ({100*data['rate']:.4f}%)\n"
-                                smart_msg += f"Re-scan at: {format_time_ist(rescan_time)} (50 min mark)\n"
-                                smart_msg += f"Enter at: {format_time_ist(entry_time)} (45 min mark)\n"
-                                smart_msg += f"Exit at: {format_time_ist(exit_time)}\n"
-                                smart_msg += f"Hold duration: ~{int(hold_duration)} min\n\n"
-                                smart_msg += f"💤 Waiting {int(wait_minutes)} minutes..."
+                                smart_msg = "".join([
+                                    f"📊 SMART WAIT PLAN:\n\n",
+                                    f"Most negative: {symbol} ({data.rate_pct_str})\n",
+                                    f"Re-scan at: {format_time_ist(rescan_time)} (50 min mark)\n",
+                                    f"Enter at: {format_time_ist(entry_time)} (45 min mark)\n",
+                                    f"Exit at: {format_time_ist(exit_time)}\n",
+                                    f"Hold duration: ~{int(hold_duration)} min\n\n",
+                                    f"💤 Waiting {int(wait_minutes)} minutes..."
+                                ])
                                 send_telegram_message(smart_msg)
                                 
-                                time.sleep(wait_time)
+                                if not interruptible_sleep(wait_time, check=_api_unreachable):
+                                    raise ConnectionError("Binance API unreachable during smart wait, entry skipped")
                                 
                                 # Re-scan at 50-min mark
                                 send_telegram_message(f"🔍 50-MIN MARK REACHED!\n\nRe-scanning for best coin...")
                                 fresh_rates = fetch_funding_rates()
-                                fresh_eligible = filter_eligible_symbols(fresh_rates, FUNDING_RATE_THRESHOLD)
                                 
-                                if fresh_eligible:
-                                    # Find most negative coin with 45-50 min left
-                                    fresh_in_window = {k: v for k, v in fresh_eligible.items() 
-                                                     if 2700 <= seconds_to_next_funding(v['interval']) <= 3000}
+                                # Find most negative coin with 45-50 min left
+                                fresh_in_window = dict(rescan_window(fresh_rates, FUNDING_RATE_THRESHOLD, 2700, 3000, time.time()))
+                                
+                                if fresh_in_window:
+                                    sorted_window = heapq.nsmallest(5, fresh_in_window.items(), key=lambda x: x[1].rate)
+                                    best_symbol, best_data = sorted_window[0]
+                                    best_rate = best_data.rate
+                                    best_time_left = best_data.sec_to_funding
+                                    
+                                    rescan_parts = [f"✅ FOUND {len(fresh_in_window)} COINS IN WINDOW:\n\n"]
+                                    rescan_parts.extend(_SCAN_LINE(sym, data.rate_pct_str, data.countdown_str) for sym, data in sorted_window)
+                                    rescan_parts.append(f"\n🎯 Best: {best_symbol} ({best_data.rate_pct_str})\n\n")
+                                    
+                                    # Calculate exact wait time to hit 45-min mark
+                                    wait_for_entry = best_time_left - 2700  # Wait until exactly 45 min
+                                    rescan_parts.append(f"⏳ Waiting {int(wait_for_entry)} seconds to enter at 45-min mark...")
+                                    send_telegram_message("".join(rescan_parts))
+                                    
+                                    time.sleep(wait_for_entry)
                                     
-                                    if fresh_in_window:
-                                        sorted_window = sorted(fresh_in_window.items(), key=lambda x: x[1]['rate'])
-                                        best_symbol = sorted_window[0][0]
-                                        best_rate = sorted_window[0][1]['rate']
-                                        best_time_left = seconds_to_next_funding(sorted_window[0][1]['interval'])
-                                        
-                                        rescan_msg = f"✅ FOUND {len(fresh_in_window)} COINS IN WINDOW:\n\n"
-                                        for sym, data in sorted_window[:5]:
-                                            countdown = format_countdown(seconds_to_next_funding(data['interval']))
-                                            rescan_msg += f"{sym}: {100*data['rate']:.4f}% ({countdown})\n"
-                                        rescan_msg += f"\n🎯 Best: {best_symbol} ({100*best_rate:.4f}%)\n\n"
-                                        
-                                        # Calculate exact wait time to hit 45-min mark
-                                        wait_for_entry = best_time_left - 2700  # Wait until exactly 45 min
-                                        rescan_msg += f"⏳ Waiting {int(wait_for_entry)} seconds to enter at 45-min mark..."
-                                        send_telegram_message(rescan_msg)
-                                        
-                                        time.sleep(wait_for_entry)
-                                        
-                                        send_telegram_message(f"⏰ 45-MIN MARK! Entering {best_symbol}...")
-                                        place_long_position(best_symbol, current_balance, best_rate)
-                                    else:
-                                        send_telegram_message(f"❌ No coins in 45-50 min window during re-scan")
+                                    send_telegram_message(f"⏰ 45-MIN MARK! Entering {best_symbol}...")
+                                    place_long_position(best_symbol, current_balance, best_rate, best_data.interval)
+                                elif any(d.rate <= FUNDING_RATE_THRESHOLD for d in fresh_rates.values()):
+                                    send_telegram_message(f"❌ No coins in 45-50 min window during re-scan")
                                 else:
                                     send_telegram_message(f"❌ No coins below -0.3% during 50-min re-scan")
                             
@@ -551,22 +1223,28 @@ def run_bot():
                                 wait_for_entry = time_left - 2700
                                 send_telegram_message(f"⏰ ALREADY IN 45-50 MIN WINDOW!\n\nWaiting {int(wait_for_entry)} seconds to enter at 45-min mark...")
                                 time.sleep(wait_for_entry)
-                                place_long_position(symbol, current_balance, data['rate'])
+                                place_long_position(symbol, current_balance, data.rate, data.interval)
                     else:
                         # Safe to sleep 1 hour - next scan will still have > 45 min
-                        print(f"Safe to scan in 1 hour. Next scan will have {int(next_scan_time_left/60)} minutes left.")
+                        log.info(f"Safe to scan in 1 hour. Next scan will have {int(next_scan_time_left/60)} minutes left.")
             
             # P&L report
             if time.time() - last_report > 43200:
                 track_pnl()
                 last_report = time.time()
             
-            print("Sleeping 1 hour...\n")
-            time.sleep(3600)
+            sleep_for = compute_next_wakeup()
+            log.info(f"Sleeping {format_countdown(sleep_for)}...")
+            # Event.wait instead of time.sleep so SIGUSR1 can trigger an early scan
+            _wake_event.wait(timeout=sleep_for)
+            _wake_event.clear()
             
         except Exception as e:
-            send_telegram_message(f"❌ Critical error: {e}")
-            time.sleep(60)
+            _back_off_after_failure(f"❌ Critical error: {e}")
 
 if __name__ == "__main__":
+    if not acquire_instance_lock():
+        raise SystemExit(f"Another bot instance holds {LOCK_FILE_PATH}")
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, _wake_on_signal)
     run_bot()